@@ -1,54 +1,93 @@
 import os
+import atexit
+import csv
+import hashlib
+import queue
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import lxml.html
+import orjson
 import logging
 import re
 from typing import Optional, Union
-import sqlite3
 import matplotlib.pyplot as plt
 import pandas as pd
 import numpy as np
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine, event, text
 from dotenv import load_dotenv
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 import schedule
 import time as tm
 import logging.handlers
 from pathlib import Path
 
 # Configuración de logging
+# Los registros se encolan y un hilo aparte (QueueListener) los escribe en disco
+log_queue = queue.Queue(-1)
 log_handler = logging.handlers.RotatingFileHandler(
     'spotify_scraper.log',
     maxBytes=5*1024*1024,  # 5 MB
     backupCount=3
 )
+log_listener = logging.handlers.QueueListener(log_queue, log_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
+# El formato se aplica en el QueueHandler; el archivo recibe el mensaje ya formateado
 logging.basicConfig(
-    handlers=[log_handler],
+    handlers=[logging.handlers.QueueHandler(log_queue)],
     level=logging.INFO,
     format='%(asctime)s - %(levelname)s - %(message)s',
     datefmt='%Y-%m-%d %H:%M:%S'
 )
 
 # Configuración de la base de datos
-DATABASE_URL = "sqlite:///spotify_records.db"
+DATABASE_PATH = "spotify_records.db"
+DATABASE_URL = f"sqlite:///{DATABASE_PATH}"
+# Un único engine (y pool de conexiones) para todo el módulo
+_ENGINE = create_engine(DATABASE_URL, connect_args={'check_same_thread': False})
+RECORD_COLUMNS = (
+    'scraping_date', 'rank', 'song', 'artist', 'streams',
+    'release_year', 'daily_average', 'record_date', 'days_on_record'
+)
 
-def safe_int(value: str) -> Optional[int]:
-    """Convierte a int de forma segura"""
-    if not value:
-        return None
-    try:
-        return int(float(value.strip().replace(',', '')))
-    except (ValueError, TypeError):
-        return None
+@event.listens_for(_ENGINE, 'connect')
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Ajustes de rendimiento de SQLite, una vez por conexión nueva"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA synchronous=OFF")
+    cursor.execute("PRAGMA journal_mode=MEMORY")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
 
-def safe_float(value: str) -> Optional[float]:
-    """Convierte a float de forma segura"""
-    if not value:
-        return None
-    try:
-        return float(value.strip().replace(',', ''))
-    except (ValueError, TypeError):
-        return None
+# Sesión HTTP reutilizable (pool de conexiones y reintentos)
+_SESSION = requests.Session()
+_SESSION.headers.update({'User-Agent': 'Mozilla/5.0'})
+_SESSION.mount('https://', HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=10,
+    max_retries=Retry(total=3, backoff_factor=0.3)
+))
+
+# Expresiones regulares precompiladas (se usan en cada fila)
+_BRACKET_RE = re.compile(r'\[.*?\]')
+_YEAR_RE = re.compile(r'\b(?:19|20)\d{2}\b')
+# Cifra de streams y unidad opcional, p. ej. "4.7 billion" o "3,100,000,000"
+_STREAMS_RE = re.compile(r'([\d.,]+)\s*(billion|million)?', re.I)
+_STREAMS_MULTIPLIER = {'billion': 1e9, 'million': 1e6}
+
+# Meses en inglés (formato fijo de Wikipedia, sin depender del locale)
+_MONTHS = {
+    'january': 1, 'february': 2, 'march': 3, 'april': 4,
+    'may': 5, 'june': 6, 'july': 7, 'august': 8,
+    'september': 9, 'october': 10, 'november': 11, 'december': 12
+}
+
+def safe_numeric(values: pd.Series) -> pd.Series:
+    """Convierte una columna de texto a número (NaN si no es válido)"""
+    # Quita referencias [xx] y separadores de miles
+    cleaned = values.str.split('[').str[0].str.strip().str.replace(',', '')
+    return pd.to_numeric(cleaned, errors='coerce')
 
 def parse_year(year_text: str) -> Optional[int]:
     """Extrae el año de diferentes formatos"""
@@ -56,11 +95,11 @@ def parse_year(year_text: str) -> Optional[int]:
         return None
     
     # Limpia referencias [xx]
-    year_text = re.sub(r'\[.*\]', '', year_text).strip()
+    year_text = _BRACKET_RE.sub('', year_text).strip()
     
     try:
         # Busca patrones de año (4 dígitos)
-        year_match = re.search(r'\b(19|20)\d{2}\b', year_text)
+        year_match = _YEAR_RE.search(year_text)
         if year_match:
             return int(year_match.group())
         
@@ -85,16 +124,16 @@ def parse_date(date_text: str) -> Optional[str]:
     
     try:
         # Para fechas como "29 November 2019"
-        date_obj = datetime.strptime(date_text, '%d %B %Y')
-        return date_obj.strftime('%Y-%m-%d')
-    except ValueError:
+        day, month, year = date_text.split()
+        date_obj = date(int(year), _MONTHS[month.lower()], int(day))
+        return date_obj.isoformat()
+    except (ValueError, KeyError):
         return None
 
 def create_database():
     """Crea la base de datos y la tabla si no existen"""
     try:
-        engine = create_engine(DATABASE_URL)
-        with engine.connect() as conn:
+        with _ENGINE.connect() as conn:
             conn.execute(text("""
             CREATE TABLE IF NOT EXISTS spotify_records (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -110,111 +149,163 @@ def create_database():
                 UNIQUE(scraping_date, rank, song, artist)
             )
             """))
+            # El índice de UNIQUE(scraping_date, rank, ...) ya resuelve el
+            # MAX(scraping_date) y el ORDER BY de la consulta de gráficos
+            # Metadatos de ejecución (p. ej. la huella de la última tabla)
+            conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS scrape_meta (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            )
+            """))
             conn.commit()
         logging.info("Base de datos verificada/creada correctamente")
     except Exception as e:
         logging.error(f"Error al crear la base de datos: {str(e)}")
         raise
 
-def scrape_spotify_records():
-    # Limpiar datos del día actual para evitar duplicados
-    engine = create_engine(DATABASE_URL)
-    with engine.connect() as conn:
+def save_rankings(rankings: pd.DataFrame, scraping_date: str) -> None:
+    """Reemplaza los registros del día con los nuevos en una sola transacción"""
+    placeholders = ', '.join('?' for _ in RECORD_COLUMNS)
+    records = rankings[list(RECORD_COLUMNS)]
+    # Tipos nativos de Python y NULL en lugar de NaN para sqlite3
+    rows = list(
+        records.astype(object).where(records.notna(), None)
+        .itertuples(index=False, name=None)
+    )
+    
+    # BEGIN ... COMMIT (o ROLLBACK si algo falla)
+    with _ENGINE.begin() as conn:
+        # Limpiar datos del día actual para evitar duplicados
         conn.execute(text("""
         DELETE FROM spotify_records 
         WHERE scraping_date = :today
-        """), {'today': datetime.now().date().strftime('%Y-%m-%d')})
-        conn.commit()
-        
+        """), {'today': scraping_date})
+        conn.exec_driver_sql(
+            f"INSERT INTO spotify_records ({', '.join(RECORD_COLUMNS)}) "
+            f"VALUES ({placeholders})",
+            rows
+        )
+    
+    # Actualiza las estadísticas del planificador solo si hace falta
+    with _ENGINE.connect() as conn:
+        conn.exec_driver_sql("PRAGMA optimize")
+
+def load_table_hash() -> Optional[str]:
+    """Devuelve la huella de la última tabla procesada por completo"""
+    with _ENGINE.connect() as conn:
+        return conn.execute(text("""
+        SELECT value FROM scrape_meta WHERE key = 'last_table_hash'
+        """)).scalar()
+
+def save_table_hash(table_hash: str) -> None:
+    """Guarda la huella de la tabla junto a los datos que representa"""
+    with _ENGINE.begin() as conn:
+        conn.execute(text("""
+        INSERT OR REPLACE INTO scrape_meta (key, value)
+        VALUES ('last_table_hash', :hash)
+        """), {'hash': table_hash})
+
+def extract_table_cells(content: bytes) -> list:
+    """Devuelve el texto de las filas de la tabla 'Most-streamed songs'"""
+    root = lxml.html.fromstring(content)
+    
+    # Encontrar la tabla "Most-streamed songs"
+    # (primera wikitable tras el encabezado; admite el id en el h2 o en
+    # el span.mw-headline del marcado antiguo de Wikipedia)
+    tables = root.xpath(
+        '//h2[@id="Most-streamed_songs" or .//span[@id="Most-streamed_songs"]]'
+        '/following::table[contains(@class, "wikitable")][1]'
+    )
+    target_table = tables[0] if tables else None
+    
+    if target_table is None:
+        raise ValueError("No se encontró la tabla 'Most-streamed songs'")
+    
+    # Extraer el texto de las celdas
+    cells = []
+    rows = target_table.xpath('.//tr')[1:]  # Saltar el encabezado
+    
+    for row in rows:
+        cols = row.xpath('./th|./td')
+        if len(cols) < 6:  # Asegurarse de que hay suficientes columnas
+            continue
+    
+        texts = [col.text_content() for col in cols[:7]]
+        texts += [None] * (7 - len(texts))
+    
+        # Fecha del récord
+        date_spans = cols[3].xpath('.//span[contains(@class, "date-style")]')
+        texts.append(date_spans[0].text_content().strip() if date_spans else None)
+        cells.append(texts)
+    
+    return cells
+
+def scrape_spotify_records():
     """Función principal para hacer scraping de los records de Spotify"""
     logging.info(f"Iniciando scraping - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+    # Fecha de scraping común a todas las filas y al borrado del día
+    today_str = datetime.now().date().isoformat()
     
     url = "https://en.wikipedia.org/wiki/List_of_Spotify_streaming_records"
-    headers = {'User-Agent': 'Mozilla/5.0'}
     
     try:
         # 1. Obtener el contenido de la página
-        response = requests.get(url, headers=headers)
+        response = _SESSION.get(url, timeout=30)
         response.raise_for_status()
-        soup = BeautifulSoup(response.text, 'html.parser')
         
-        # 2. Encontrar la tabla "Most-streamed songs"
-        target_table = None
-        for table in soup.find_all('table', {'class': 'wikitable'}):
-            prev_header = table.find_previous('h2')
-            if prev_header and "Most-streamed songs" in prev_header.text:
-                target_table = table
-                break
-                
-        if not target_table:
-            raise ValueError("No se encontró la tabla 'Most-streamed songs'")
+        # 2. Extraer el texto de la tabla "Most-streamed songs"
+        # (el árbol HTML se libera al volver de la función)
+        cells = extract_table_cells(response.content)
+        del response
         
-        # 3. Extraer datos de la tabla
-        rankings = []
-        rows = target_table.find_all('tr')[1:]  # Saltar el encabezado
+        # Si la tabla no cambió desde la última ejecución no hay nada que hacer
+        table_hash = hashlib.blake2b(orjson.dumps(cells), digest_size=16).hexdigest()
+        if load_table_hash() == table_hash:
+            logging.info("Sin cambios en la tabla desde la última ejecución")
+            return
         
-        for row in rows:
-            cols = row.find_all(['th', 'td'])
-            if len(cols) < 6:  # Asegurarse de que hay suficientes columnas
-                continue
-                
-            try:
-                # Extraer y limpiar datos
-                rank = safe_int(cols[0].text)
-                song = cols[1].text.strip().replace('"', '')
-                artist = cols[2].text.strip()
-                
-                # Streams (maneja billones/millones si es necesario)
-                streams_text = cols[3].text.split('[')[0].strip().lower()
-                if 'billion' in streams_text:
-                    streams = safe_float(streams_text.replace(' billion', '')) * 1e9
-                elif 'million' in streams_text:
-                    streams = safe_float(streams_text.replace(' million', '')) * 1e6
-                else:
-                    streams = safe_float(streams_text.replace(',', ''))
-                
-                # Fecha de lanzamiento
-                release_year = parse_year(cols[4].text)
-                
-                # Promedio diario
-                daily_avg_text = cols[5].text.split('[')[0].strip().lower()
-                daily_avg = safe_float(daily_avg_text.replace(',', ''))
-                
-                # Fecha del récord
-                record_date = None
-                date_span = cols[3].find('span', {'class': 'date-style'})
-                if date_span:
-                    record_date = parse_date(date_span.text.strip())
-                
-                # Días en el récord
-                days_text = cols[6].text.split('[')[0].strip() if len(cols) > 6 else None
-                days_on_record = safe_int(days_text)
-                
-                rankings.append({
-                    'scraping_date': datetime.now().date().strftime('%Y-%m-%d'),
-                    'rank': rank,
-                    'song': song,
-                    'artist': artist,
-                    'streams': streams,
-                    'release_year': release_year,
-                    'daily_average': daily_avg,
-                    'record_date': record_date,
-                    'days_on_record': days_on_record
-                })
-                
-            except Exception as e:
-                logging.warning(f"Error procesando fila: {str(e)}\nContenido: {cols}")
-                continue
+        raw = pd.DataFrame(cells, columns=[
+            'rank', 'song', 'artist', 'streams', 'release',
+            'daily_average', 'days_on_record', 'record_date'
+        ], dtype=object)
+        
+        # 3. Limpiar los datos por columnas
+        # Streams (maneja billones/millones si es necesario)
+        streams_parts = raw['streams'].str.extract(_STREAMS_RE)
+        multiplier = streams_parts[1].str.lower().map(_STREAMS_MULTIPLIER).fillna(1.0)
+        streams = pd.to_numeric(
+            streams_parts[0].str.replace(',', ''), errors='coerce'
+        ) * multiplier
+        
+        rankings = pd.DataFrame({
+            'scraping_date': today_str,
+            'rank': safe_numeric(raw['rank']),
+            'song': raw['song'].str.strip().str.replace('"', ''),
+            'artist': raw['artist'].str.strip(),
+            'streams': streams,
+            'release_year': raw['release'].map(parse_year),
+            'daily_average': safe_numeric(raw['daily_average']),
+            'record_date': raw['record_date'].map(parse_date, na_action='ignore'),
+            'days_on_record': np.trunc(safe_numeric(raw['days_on_record']))
+        })
+        
+        # El ranking es obligatorio en la tabla
+        invalid = rankings['rank'].isna()
+        if invalid.any():
+            logging.warning(f"Filas descartadas sin ranking válido: {int(invalid.sum())}")
+            rankings = rankings[~invalid]
+        rankings = rankings.astype({'rank': int})
         
         # 4. Guardar en la base de datos
-        if rankings:
-            engine = create_engine(DATABASE_URL)
-            df = pd.DataFrame(rankings)
-            df.to_sql('spotify_records', engine, if_exists='append', index=False)
+        if not rankings.empty:
+            save_rankings(rankings, today_str)
             logging.info(f"Datos guardados correctamente - {len(rankings)} registros")
             
-            # Generar visualizaciones
-            generate_daily_charts()
+            # Generar visualizaciones; la huella solo se guarda si todo fue
+            # bien, para que un fallo se reintente en la próxima ejecución
+            if generate_daily_charts():
+                save_table_hash(table_hash)
         else:
             logging.warning("No se encontraron datos para guardar")
             
@@ -222,10 +313,22 @@ def scrape_spotify_records():
         logging.error(f"Error durante el scraping: {str(e)}")
         raise
 
-def generate_daily_charts():
-    """Genera ambos gráficos actualizados con datos del día"""
+# Figuras reutilizadas entre ejecuciones (se limpian en vez de recrearse)
+_FIGURES = {}
+
+def _reuse_figure(name: str, figsize: tuple) -> plt.Figure:
+    """Devuelve la figura cacheada con ese nombre, vacía y lista para dibujar"""
+    fig = _FIGURES.get(name)
+    if fig is None:
+        fig = _FIGURES[name] = plt.figure(figsize=figsize)
+    else:
+        fig.clf()
+    return fig
+
+def generate_daily_charts() -> bool:
+    """Genera ambos gráficos actualizados con datos del día (True si no hubo errores)"""
     try:
-        conn = sqlite3.connect('spotify_records.db')
+        conn = _ENGINE.connect()
         current_datetime = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
 
         # Crear carpeta para guardar los gráficos
@@ -238,32 +341,54 @@ def generate_daily_charts():
         # Crear la carpeta si no existe
         ruta_carpeta.mkdir(exist_ok=True)
 
-        # --- Gráfico 1: Evolución de una canción del ranking ---
         #Canción
         song = 'Die With A Smile'
         
-        # Consulta para obtener todos los datos de la canción
-        query = f"""
-        SELECT scraping_date, rank, streams, daily_average 
+        # Una sola consulta para ambos gráficos: el historial de la canción
+        # y las filas del último día; se separan después en pandas
+        query = """
+        SELECT scraping_date, rank, song, artist, streams, daily_average 
         FROM spotify_records 
-        WHERE song LIKE '%{song}%' 
-        ORDER BY scraping_date
+        WHERE song LIKE ? 
+           OR scraping_date = (SELECT MAX(scraping_date) FROM spotify_records)
+        ORDER BY scraping_date, rank
         """
-        df = pd.read_sql(query, conn)
+        df_all = pd.read_sql(query, conn, params=(f'%{song}%',))
+        
+        # --- Gráfico 1: Evolución de una canción del ranking ---
+        # (LIKE de SQLite no distingue mayúsculas en ASCII)
+        song_mask = df_all['song'].str.contains(song, case=False, regex=False)
+        df = df_all.loc[song_mask, ['scraping_date', 'rank', 'streams', 'daily_average']]
+        df = df.reset_index(drop=True)
         
         if not df.empty:
             # 1. Guardar datos en CSV (append mode)
             csv_filename = 'charts/song_evolution_data.csv'
-            df.to_csv(csv_filename, mode='a', header=not os.path.exists(csv_filename), index=False)
+            with open(csv_filename, 'a', newline='') as f:
+                # Mismo fin de línea que usaba to_csv
+                writer = csv.writer(f, lineterminator=os.linesep)
+                # En modo 'a' la posición inicial es el final del archivo
+                if f.tell() == 0:
+                    writer.writerow(df.columns)
+                # Los NaN se escriben como celdas vacías, igual que to_csv
+                writer.writerows(
+                    df.astype(object).where(df.notna(), None)
+                    .itertuples(index=False, name=None)
+                )
             
             # 2. Procesar datos para el gráfico
-            df['scraping_date'] = pd.to_datetime(df['scraping_date'])
+            # (arrays de numpy: matplotlib no tiene que convertir Series ni Timestamps)
+            dates = pd.to_datetime(df['scraping_date']).to_numpy()
+            ranks = df['rank'].to_numpy()
+            streams_b = df['streams'].to_numpy() / 1e9
+            daily_avg_m = df['daily_average'].to_numpy() / 1e6
             
             # Crear gráfico
-            fig, ax1 = plt.subplots(figsize=(12, 6))
+            fig = _reuse_figure('song_evolution', (12, 6))
+            ax1 = fig.add_subplot()
             
             # Gráfico de ranking
-            ax1.plot(df['scraping_date'], df['rank'], 'ro-', label='Ranking')
+            ax1.plot(dates, ranks, 'ro-', label='Ranking')
             ax1.invert_yaxis()
             ax1.set_xlabel('Fecha')
             ax1.set_ylabel('Ranking', color='red')
@@ -271,20 +396,19 @@ def generate_daily_charts():
             
             # Gráfico de streams (eje secundario)
             ax2 = ax1.twinx()
-            ax2.plot(df['scraping_date'], df['streams']/1e9, 'b--', label='Streams (B)')
-            ax2.plot(df['scraping_date'], df['daily_average']/1e6, 'g:', label='Avg. Diario (M)')
+            ax2.plot(dates, streams_b, 'b--', label='Streams (B)')
+            ax2.plot(dates, daily_avg_m, 'g:', label='Avg. Diario (M)')
             ax2.set_ylabel('Streams', color='blue')
             ax2.tick_params(axis='y', labelcolor='blue')
             
             # Título y leyenda unificada
-            plt.title(f'Evolución de "{song}" en Spotify\nÚltima actualización: {datetime.now().strftime("%Y-%m-%d %H:%M")}')
+            ax1.set_title(f'Evolución de "{song}" en Spotify\nÚltima actualización: {datetime.now().strftime("%Y-%m-%d %H:%M")}')
             lines1, labels1 = ax1.get_legend_handles_labels()
             lines2, labels2 = ax2.get_legend_handles_labels()
             ax2.legend(lines1 + lines2, labels1 + labels2, loc='upper left')
             
             # Guardar siempre con el mismo nombre (sobrescribe)
-            plt.savefig('charts/song_evolution_current.png', dpi=150, bbox_inches='tight')
-            plt.close()
+            fig.savefig('charts/song_evolution_current.png', dpi=150, bbox_inches='tight')
             
             print(f"Gráfico 1 actualizado: song_evolution_current.png")
             print(f"Datos guardados en: {csv_filename}")
@@ -292,17 +416,13 @@ def generate_daily_charts():
             print(f"No hay datos para '{song}'")
 
         # --- Gráfico 2: Top 10 canciones del día ---
-        df_top10 = pd.read_sql("""
-            SELECT song, artist, streams 
-            FROM spotify_records 
-            WHERE scraping_date = (SELECT MAX(scraping_date) FROM spotify_records)
-            ORDER BY rank 
-            LIMIT 10
-        """, conn)
+        latest = df_all['scraping_date'] == df_all['scraping_date'].max()
+        df_top10 = df_all.loc[latest].nsmallest(10, 'rank')[['song', 'artist', 'streams']]
 
         if not df_top10.empty:
-            plt.figure(figsize=(12, 7))
-            bars = plt.barh(
+            fig = _reuse_figure('top10', (12, 7))
+            ax = fig.add_subplot()
+            bars = ax.barh(
                 df_top10['song'] + '\n' + df_top10['artist'],                
                 df_top10['streams'],
                 color='#1DB954',
@@ -312,24 +432,30 @@ def generate_daily_charts():
             # Añadir etiquetas de valor
             for bar in bars:
                 width = bar.get_width()
-                plt.text(width, bar.get_y() + bar.get_height()/2, 
+                ax.text(width, bar.get_y() + bar.get_height()/2, 
                         f'{width:.2f}B', 
                         ha='left', va='center',
                         fontsize=10)
             
-            plt.title(f'Top 10 Canciones en Spotify\nActualizado: {datetime.now().strftime("%Y-%m-%d %H:%M")}', fontsize=14, pad=20)
-            plt.xlabel('Streams (miles de millones)', fontsize=12)
-            plt.xticks(fontsize=10)
-            plt.yticks(fontsize=10)
-            plt.tight_layout()
-            plt.savefig(f'charts/top10_songs_{current_datetime}.png', dpi=150, bbox_inches='tight')
-            plt.close()
+            ax.set_title(f'Top 10 Canciones en Spotify\nActualizado: {datetime.now().strftime("%Y-%m-%d %H:%M")}', fontsize=14, pad=20)
+            ax.set_xlabel('Streams (miles de millones)', fontsize=12)
+            ax.tick_params(axis='both', labelsize=10)
+            # Una sola pasada de layout; sin bbox_inches='tight' se evita
+            # un segundo renderizado, y compress_level=1 acelera el PNG
+            fig.tight_layout()
+            fig.savefig(
+                f'charts/top10_songs_{current_datetime}.png',
+                dpi=100,
+                pil_kwargs={'compress_level': 1}
+            )
 
         print(f"Gráficos actualizados generados en {current_datetime}")
+        return True
 
     except Exception as e:
         print(f"Error generando gráficos: {str(e)}")
         logging.error(f"Error generando gráficos: {str(e)}")
+        return False
     finally:
         conn.close()
         